@@ -9,67 +9,317 @@ Usage examples are in the README.
 """
 
 import argparse
+import asyncio
+import codecs
+import contextlib
+import functools
 import getpass
+import itertools
+import multiprocessing
+import queue
+import random
 import re
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from html import unescape
 from urllib.parse import urlparse, urljoin
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 
 SHORTCODE_TPL = ('[osm_map_v3 map_center="autolat,autolon" zoom="autozoom" '
                  'width="100%" height="450" file_list="{relpath}" '
                  'file_color_list="red" file_title="{title}"]')
 
+# Track file formats (link path extension) and the shortcode inserted for
+# each; --formats picks which are looked for (see track_matcher). osm_map_v3
+# reads all of these through file_list, so they share SHORTCODE_TPL; an entry
+# only needs its own template to give that format a different map (e.g.
+# another height or colour). The keys are what defines the formats. Maps
+# merged by --merge-tracks always use MERGED_SHORTCODE_TPL instead.
+TRACK_RULES = {
+    'gpx': SHORTCODE_TPL,
+    'kml': SHORTCODE_TPL,
+    'kmz': SHORTCODE_TPL,
+    'geojson': SHORTCODE_TPL,
+}
+DEFAULT_FORMATS = ('gpx',)
 
-def find_gpx_links(html, site_base_url):
-    """Return list of tuples (a_tag, gpx_url, title) for each .gpx link found.
+# --merge-tracks: one map showing all of a post's tracks, coloured in turn,
+# whatever their formats (TRACK_RULES templates are not used for these)
+MERGED_SHORTCODE_TPL = ('[osm_map_v3 map_center="autolat,autolon" zoom="autozoom" '
+                        'width="100%" height="450" file_list="{relpaths}" '
+                        'file_color_list="{colours}" file_title="{titles}"]')
+TRACK_COLOURS = ('red', 'blue', 'green', 'purple', 'orange', 'black', 'brown', 'grey')
 
-    a_tag is the BeautifulSoup tag object for the <a> element.
-    gpx_url is the absolute URL to the GPX file.
-    title is a short derived title.
+# file_list of osm_map_v3 shortcodes already in a post (comma separated paths)
+OSM_SHORTCODE_RE = re.compile(r'\[osm_map_v3\b[^\]]*?\bfile_list\s*=\s*(["\'])(.*?)\1', re.IGNORECASE)
+# Cheap test run before a post's HTML is parsed (see find_gpx_links)
+HREF_RE = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.IGNORECASE)
+
+# Block editor content: shortcodes go in their own block, before the block of the link
+BLOCK_DELIMITER_RE = re.compile(r'<!--\s+(/)?wp:([a-z][a-z0-9_-]*(?:/[a-z][a-z0-9_-]*)?)\s+(?:\{.*?\}\s+)?(/)?-->',
+                                re.DOTALL)
+SHORTCODE_BLOCK_TPL = '<!-- wp:shortcode -->\n{shortcode}\n<!-- /wp:shortcode -->\n\n'
+
+RENDERED_CONTENT_WARNING = "Warning: using rendered post content (shortcodes may already be expanded)."
+
+# Post fields main() reads; requested via _fields so the API skips the rest
+# (excerpt, meta, _links, ...) and only renders content when it is needed.
+POST_FIELDS = ('id', 'type', 'slug', 'link', 'guid.rendered', 'title.rendered')
+UPDATE_FIELDS = 'id'
+
+DEFAULT_ROUTE = 'wp/v2/posts'
+# Registered post types that hold no post content worth scanning
+NON_CONTENT_TYPES = ('attachment', 'nav_menu_item', 'wp_block', 'wp_template', 'wp_template_part',
+                     'wp_navigation', 'wp_global_styles', 'wp_font_family', 'wp_font_face')
+
+# Run-wide counters, reported in the summary. Updated from worker threads.
+metrics = Counter()
+_metrics_lock = threading.Lock()
+
+
+def count(name, n=1):
+    with _metrics_lock:
+        metrics[name] += n
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Add the time spent in the block to the busy_<stage> counter."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count(f'busy_{stage}', time.perf_counter() - start)
+
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    """print() for messages from worker threads, keeping each on its own line."""
+    with _print_lock:
+        print(message)
+
+
+def post_fields(auth):
+    """Return the _fields projection for post listings. Authenticated runs
+    read the raw source, so the rendered content is not requested at all.
+    """
+    content = 'content.raw' if auth else 'content.rendered'
+    return ','.join(POST_FIELDS + (content,))
+
+
+# Bounded memo caches for URL handling: the same upload URLs and post
+# directories come up again and again across a site (see URL_CACHES)
+URL_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def resolve_href(site_base_url, href):
+    """Return (absolute URL, path) for an href; absolute hrefs are not joined."""
+    abs_url = href if href.startswith(('http://', 'https://')) else urljoin(site_base_url, href)
+    return abs_url, urlparse(abs_url).path
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _url_parts(url):
+    parsed = urlparse(url)
+    return parsed.netloc, parsed.path
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _file_key(url):
+    """Reduce a file URL, or a path from a shortcode file_list, to a form
+    that can be compared: its path without the host or leading / and ../
     """
+    return re.sub(r'^(?:\.\.?/|/)+', '', urlparse(url.strip()).path)
+
+
+def mapped_files(html):
+    """Return the files (see _file_key) already shown by osm_map_v3 shortcodes in html."""
+    files = {_file_key(path) for m in OSM_SHORTCODE_RE.finditer(html) for path in m.group(2).split(',')}
+    files.discard('')
+    return files
+
+
+Anchor = namedtuple('Anchor', 'href text start end')
+Anchor.__doc__ = """A link in post HTML: its href and text as written and the offsets of
+the whole <a>...</a> element in the source."""
+
+# The inside of a start tag: a '>' within a quoted attribute value does not end it
+TAG_ATTRS = r'(?:[^>"\']|"[^"]*"|\'[^\']*\')*'
+# Single-pass tokenizer: comments and script/style bodies are matched (and
+# skipped) so links inside them are not reported, as with a real parser.
+ANCHOR_TOKEN_RE = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>'
+                             r'|<a\b(' + TAG_ATTRS + r')>((?:(?!</a\b).)*)</a>', re.IGNORECASE | re.DOTALL)
+COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+ATTR_RE = re.compile(r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+)))?')
+# <p> and </p> tags (group 2 is '/' or ''); comments and script/style bodies
+# are matched too, with group 2 None, so tags inside them are skipped
+P_TAG_RE = re.compile(r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|<(/?)p(?=[\s>])', re.IGNORECASE | re.DOTALL)
+LINE_PREFIX_RE = re.compile(r'\s*(?:<p[^>]*>\s*)?', re.IGNORECASE)
+LINE_SUFFIX_RE = re.compile(r'(?:\s*</p>)?\s*', re.IGNORECASE)
+
+
+def _locate_anchors(html, links):
+    """Find the <a ... href=...>text</a> of each parsed (href, text) link in
+    the original HTML source (handles attribute order/spacing). Links are in
+    document order, so each is searched for after the previous one, skipping
+    comments. Yields an Anchor for each link found.
+    """
+    comments = [m.span() for m in COMMENT_RE.finditer(html)] if '<!--' in html else []
+    pos = 0
+    for href, text in links:
+        anchor_regex = re.compile(r'<a\b' + TAG_ATTRS + r'\bhref\s*=\s*(?:"|\')?' + re.escape(href) + r'(?:"|\')?'
+                                  + TAG_ATTRS + r'>\s*' + re.escape(text) + r'\s*</a>', flags=re.IGNORECASE)
+        for m in anchor_regex.finditer(html, pos):
+            if not any(start <= m.start() < end for start, end in comments):
+                pos = m.end()
+                yield Anchor(href, text, m.start(), m.end())
+                break
+
+
+def _anchors_bs4(html, wanted):
+    """Parse with html.parser and locate each wanted link in the source."""
     soup = BeautifulSoup(html, "html.parser")
-    results = []
-    for a in soup.find_all('a', href=True):
-        href = a['href']
-        # Normalize to absolute URL and check the path portion for .gpx
-        abs_url = urljoin(site_base_url, href)
-        path = urlparse(abs_url).path or ''
-        if not path.lower().rstrip('/').endswith('.gpx'):
-            continue
+    return _locate_anchors(html, [(a['href'], a.get_text(strip=True))
+                                  for a in soup.find_all('a', href=True) if wanted(a['href'])])
+
+
+def _anchors_lxml(html, wanted):
+    """As _anchors_bs4, parsing with lxml (optional dependency, faster)."""
+    import lxml.html
+    if not html.strip():
+        return []
+    root = lxml.html.fragment_fromstring(html, create_parent='div')
+    return _locate_anchors(html, [(a.get('href'), a.text_content().strip())
+                                  for a in root.iter('a') if a.get('href') is not None and wanted(a.get('href'))])
 
-        # Use the anchor text as the title (prefer user-visible text)
-        anchor_text = a.get_text(strip=True)
-
-        # Build a robust regex to find an <a ... href=...>anchor_text</a> in the
-        # original HTML source. This handles attribute order/spacing.
-        href_pat = re.escape(href)
-        inner = re.escape(anchor_text)
-        anchor_regex = re.compile(r'<a\b[^>]*\bhref\s*=\s*(?:"|\')?' + href_pat + r'(?:"|\')?[^>]*>\s*' + inner + r'\s*</a>', flags=re.IGNORECASE)
-        m = anchor_regex.search(html)
-        if not m:
-            continue
 
-        # Ensure the matched anchor is the only content on its line (allow optional <p> wrapper)
-        idx = m.start()
-        matched_str = m.group(0)
-        line_start = html.rfind('\n', 0, idx) + 1
-        line_end = html.find('\n', idx)
-        if line_end == -1:
-            line_end = len(html)
-        line = html[line_start:line_end]
-
-        # Pattern allows optional surrounding <p> tags and whitespace only
-        pattern = r'^\s*(?:<p[^>]*>\s*)?' + re.escape(matched_str) + r'(?:\s*</p>)?\s*$'
-        if not re.match(pattern, line, flags=re.IGNORECASE):
+def _anchors_tokenizer(html, wanted):
+    """Find links in one regex pass over the source, with exact offsets.
+    Like the parser engines, links whose text contains markup or character
+    references are not reported.
+    """
+    for m in ANCHOR_TOKEN_RE.finditer(html):
+        if m.group(2) is None:
+            continue
+        href = _href_attr(m.group(2))
+        if href is None:
+            continue
+        text = m.group(3).strip()
+        if '<' in text or ('&' in text and unescape(text) != text) or ('&' in href and unescape(href) != href):
             continue
+        if wanted(href):
+            yield Anchor(href, text, m.start(), m.end())
+
+
+def _href_attr(attrs):
+    """The value of the first href in a start tag's attributes, or None."""
+    for attr in ATTR_RE.finditer(attrs):
+        if attr.group(1).lower() == 'href':
+            value = next((value for value in attr.groups()[1:] if value is not None), None)
+            if value is not None:
+                return value
+    return None
+
+
+DETECTION_ENGINES = {'bs4': _anchors_bs4, 'lxml': _anchors_lxml, 'tokenizer': _anchors_tokenizer}
+
+
+def _alone_on_line(html, start, end):
+    """True if html[start:end] is the only content on its line, allowing an
+    optional <p> wrapper.
+    """
+    line_start = html.rfind('\n', 0, start) + 1
+    line_end = html.find('\n', end)
+    if line_end == -1:
+        line_end = len(html)
+    return ('\n' not in html[start:end] and LINE_PREFIX_RE.fullmatch(html, line_start, start) is not None
+            and LINE_SUFFIX_RE.fullmatch(html, end, line_end) is not None)
+
+
+@functools.lru_cache(maxsize=None)
+def track_matcher(formats):
+    """Compile the TRACK_RULES for formats (a tuple of names) into one
+    matcher: returns (extension_re, path_re). extension_re finds any of the
+    extensions in a document; path_re matches a link path of one of the
+    formats, with the format (lower case) as group 1 after .lower().
+    """
+    extensions = '|'.join(re.escape(name) for name in sorted(formats, key=len, reverse=True))
+    return re.compile(rf'\.(?:{extensions})', re.IGNORECASE), re.compile(rf'\.({extensions})/*$')
+
+
+def track_format(file_url, formats=tuple(TRACK_RULES)):
+    """Return the TRACK_RULES format of a file URL, or None."""
+    m = track_matcher(formats)[1].search(_url_parts(file_url)[1].lower())
+    return m.group(1) if m else None
+
+
+def find_gpx_links(html, site_base_url, engine='bs4', formats=DEFAULT_FORMATS):
+    """Return list of tuples (anchor, file_url, title) for each track link
+    found: a link to a file of one of `formats` (TRACK_RULES names; all are
+    matched in one pass, so more formats cost nothing extra).
+
+    anchor is the Anchor for the <a> element.
+    file_url is the absolute URL to the track file.
+    title is a short derived title.
+    engine names the DETECTION_ENGINES entry used to find the links; all of
+    them report the same links (see --compare-engines).
+    Links to files already in an osm_map_v3 shortcode's file_list are left
+    out, so running the script again adds nothing.
+
+    Most posts have no track links, so the HTML only reaches the engine
+    after a cascade of cheaper tests, each counting the posts it rejects: a
+    case-insensitive search for the extensions, then a scan of href values
+    for a track path, then a check for links not already mapped.
+    """
+    extension_re, path_re = track_matcher(tuple(formats))
 
-        title = anchor_text
-        results.append((a, abs_url, title))
+    def is_track(href):
+        # Normalize to absolute URL and check the path portion for a track extension
+        return path_re.search(resolve_href(site_base_url, href)[1].lower()) is not None
+
+    if not extension_re.search(html):
+        count('rejected_substring')
+        return []
+    gpx_hrefs = [href for values in HREF_RE.findall(html) for href in values if href and is_track(href)]
+    if not gpx_hrefs:
+        count('rejected_href_scan')
+        return []
+    mapped = mapped_files(html)
+    if mapped:
+        gpx_files = [_file_key(resolve_href(site_base_url, href)[0]) for href in gpx_hrefs]
+        if all(key in mapped for key in gpx_files):
+            count('links_already_mapped', len(gpx_files))
+            count('rejected_mapped')
+            return []
+    count('parsed')
+    results = []
+    for anchor in DETECTION_ENGINES[engine](html, is_track):
+        abs_url = resolve_href(site_base_url, anchor.href)[0]
+        if _file_key(abs_url) in mapped:
+            count('links_already_mapped')
+            continue
+        # Ensure the anchor is the only content on its line (allow optional <p> wrapper)
+        if not _alone_on_line(html, anchor.start, anchor.end):
+            continue
+        # Use the anchor text as the title (prefer user-visible text)
+        results.append((anchor, abs_url, anchor.text))
     return results
 
 
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
 def compute_relative_path(file_url, post_url):
     """Compute a relative path from the post URL to the file URL.
 
@@ -79,16 +329,22 @@ def compute_relative_path(file_url, post_url):
     This function returns a path using '..' segments to reach the root, then the
     absolute path to the file.
     """
-    file_parsed = urlparse(file_url)
-    post_parsed = urlparse(post_url)
+    file_netloc, file_path = _url_parts(file_url)
+    post_netloc, post_path = _url_parts(post_url)
 
     # Only handle same-netloc; if different, still return absolute path
-    if file_parsed.netloc != post_parsed.netloc:
+    if file_netloc != post_netloc:
         return file_url
 
-    file_path = file_parsed.path
-    post_path = post_parsed.path
-    # Count directory depth of post path
+    rel = '/'.join(_ups_to_root(post_path) + (file_path.lstrip('/'),))
+    if not rel:
+        rel = file_path
+    return rel
+
+
+@functools.lru_cache(maxsize=URL_CACHE_SIZE)
+def _ups_to_root(post_path):
+    """Return the '..' segments leading from the directory of post_path to the root."""
     # If post_path ends with '/', treat as directory; otherwise remove last segment
     if post_path.endswith('/'):
         post_dir = post_path
@@ -98,62 +354,542 @@ def compute_relative_path(file_url, post_url):
     # compute number of segments in post_dir after leading '/'
     post_segments = [s for s in post_dir.split('/') if s]
     # For each segment, we need a '..' to go up
-    ups = ['..'] * len(post_segments)
-    rel = '/'.join(ups + [file_path.lstrip('/')])
-    if not rel:
-        rel = file_path
-    return rel
+    return ('..',) * len(post_segments)
+
+
+URL_CACHES = {'href': resolve_href, 'url': _url_parts, 'file key': _file_key, 'relative path': compute_relative_path,
+              'post depth': _ups_to_root}
 
 
-def insert_shortcode_into_html(html, link_tag, shortcode):
-    """Insert shortcode (plain text) in the HTML before the paragraph that
-    contains link_tag. Returns modified HTML string. If paragraph not found,
-    insert before the link_tag itself.
+def url_cache_counts():
+    """Return the hits and misses of each of this process's URL_CACHES as a Counter."""
+    counts = Counter()
+    for name, cached in URL_CACHES.items():
+        info = cached.cache_info()
+        counts[f'url_cache_hits_{name}'] = info.hits
+        counts[f'url_cache_misses_{name}'] = info.misses
+    return counts
+
+
+def insertion_points(html, offsets):
+    """For each offset (ascending) return where a shortcode for the link
+    there goes: the start of the enclosing <p>, or the offset itself when
+    the link is not in a paragraph. One pass over the <p> tags of html,
+    ignoring any inside comments and script/style elements.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    # find the same tag in the new soup by matching href and text
-    target = None
-    for a in soup.find_all('a', href=True):
-        if a.get('href') == link_tag.get('href') and a.get_text(strip=True) == link_tag.get_text(strip=True):
-            target = a
-            break
-
-    if target is None:
-        return html
-
-    # find enclosing paragraph
-    parent_p = target.find_parent('p')
-    sc_node = BeautifulSoup(shortcode, 'html.parser')
-    if parent_p is not None:
-        parent_p.insert_before(sc_node)
-    else:
-        target.insert_before(sc_node)
+    points = []
+    tags = P_TAG_RE.finditer(html)
+    tag = next(tags, None)
+    open_at = None
+    for offset in offsets:
+        while tag is not None and tag.start() < offset:
+            if tag.group(2) is not None:
+                open_at = None if tag.group(2) else tag.start()
+            tag = next(tags, None)
+        points.append(offset if open_at is None else open_at)
+    return points
 
-    return str(soup)
 
+def block_insertion_points(html, offsets):
+    """For block editor content: for each offset (ascending) return the
+    start of the paragraph block holding it (failing that, of its top-level
+    block), or None when it is outside any block. The block delimiter
+    comments are read in one pass; no DOM is built.
+    """
+    points = []
+    delimiters = BLOCK_DELIMITER_RE.finditer(html)
+    delimiter = next(delimiters, None)
+    open_blocks = []
+    for offset in offsets:
+        while delimiter is not None and delimiter.start() < offset:
+            closer, name, void = delimiter.groups()
+            if closer:
+                while open_blocks and open_blocks.pop()[0] != name:
+                    pass
+            elif not void:
+                open_blocks.append((name, delimiter.start()))
+            delimiter = next(delimiters, None)
+        paragraphs = [start for name, start in open_blocks if name in ('paragraph', 'core/paragraph')]
+        points.append(paragraphs[-1] if paragraphs else open_blocks[0][1] if open_blocks else None)
+    return points
 
-def get_posts(site_api_url, per_page=100, auth=None):
-    """Generator yielding posts from WP REST API /wp/v2/posts?page=N
-    Fetches all pages until none left.
+
+def splice(html, inserts):
+    """Return html with each (offset, text) of inserts inserted, in one pass.
+    Texts for the same offset keep their order; all other bytes are kept.
+    """
+    pieces = []
+    last = 0
+    for offset, text in sorted(inserts, key=lambda insert: insert[0]):
+        pieces += (html[last:offset], text)
+        last = offset
+    pieces.append(html[last:])
+    return ''.join(pieces)
+
+
+class RetryPolicy:
+    """Retry policy shared by every read and write of a run.
+
+    Throttled/unavailable responses (RETRY_STATUSES) and connection errors are
+    retried up to max_retries times per request, waiting for the server's
+    Retry-After when given and otherwise an exponential backoff with full
+    jitter. `budget` caps the number of retries over the whole run so a
+    struggling site isn't hammered indefinitely.
+    """
+
+    RETRY_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0, budget=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self._used = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def retry_after(resp):
+        """Return the Retry-After delay of resp in seconds, or None."""
+        value = resp.headers.get('Retry-After') if resp is not None else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def next_delay(self, attempt, resp=None):
+        """Return the seconds to wait before retrying a request that has
+        failed `attempt` + 1 times, or None to give up.
+        """
+        if attempt >= self.max_retries:
+            return None
+        with self._lock:
+            if self.budget is not None and self._used >= self.budget:
+                count('retries_refused')
+                return None
+            self._used += 1
+        delay = self.retry_after(resp)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        count('retries')
+        count('backoff_seconds', delay)
+        return delay
+
+
+class RetryAdapter(HTTPAdapter):
+    """HTTPAdapter that retries requests according to a RetryPolicy."""
+
+    def __init__(self, policy, **kwargs):
+        self.policy = policy
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                resp, error = super().send(request, **kwargs), None
+            except (requests.ConnectionError, requests.Timeout) as e:
+                resp, error = None, e
+            if error is None and resp.status_code not in self.policy.RETRY_STATUSES:
+                return resp
+            delay = self.policy.next_delay(attempt, resp)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return resp
+            reason = error if error is not None else f"HTTP {resp.status_code}"
+            log(f"{request.method} {request.url}: {reason}; retrying in {delay:.1f}s")
+            if resp is not None:
+                resp.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+def make_session(auth=None, pool_size=10, retry=None):
+    """Return a requests.Session whose connection pool can keep pool_size
+    connections to the site open, so concurrent requests reuse keep-alive
+    connections instead of opening new ones. Requests are retried according
+    to `retry` (a RetryPolicy); by default they are not retried.
     """
-    page = 1
     session = requests.Session()
+    adapter = RetryAdapter(retry or RetryPolicy(max_retries=0), pool_connections=pool_size,
+                           pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
     if auth:
         session.auth = auth
-    while True:
-        params = {'per_page': per_page, 'page': page}
-        # request edit context when authenticated to get raw source (shortcodes unexpanded)
-        if auth:
-            params['context'] = 'edit'
-        resp = session.get(f"{site_api_url.rstrip('/')}/wp/v2/posts", params=params)
-        if resp.status_code == 404:
-            print("API endpoint not found (404). Check the site URL and API base path.")
-            break
-        resp.raise_for_status()
-        items = resp.json()
-        if not items:
-            break
+    return session
+
+
+class CacheMiss(LookupError):
+    """A page needed by an --offline run is not in the page cache."""
+
+
+class PageCache:
+    """Local store of listing page responses, kept in a SQLite file.
+
+    Each entry holds the ETag/Last-Modified validators, the pagination headers
+    and the body of one request (URL, parameters and user). fetch_posts_page
+    serves entries younger than `ttl` seconds without contacting the site,
+    revalidates older ones with a conditional GET (a 304 is answered from the
+    stored body) and, when `offline`, never contacts the site at all (a page
+    that is not stored raises CacheMiss). The least recently used entries
+    are evicted once the stored bodies exceed `max_bytes`.
+    """
+
+    SCHEMA_VERSION = 2
+    # Response headers that are replayed when a page is served from the cache
+    KEPT_HEADERS = ('X-WP-Total', 'X-WP-TotalPages')
+
+    def __init__(self, path, ttl=None, max_bytes=None, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            # Older cache layout: it is only a cache, so start again
+            with self._db:
+                self._db.execute('DROP TABLE IF EXISTS pages')
+                self._db.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, etag TEXT, '
+                         'last_modified TEXT, headers TEXT, body TEXT, size INTEGER, '
+                         'stored_at REAL, used_at REAL)')
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    @staticmethod
+    def key(url, params, auth=None):
+        user = auth[0] if auth else ''
+        return json.dumps([url, sorted(params.items()), user])
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute('SELECT etag, last_modified, headers, body, stored_at FROM pages WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE pages SET used_at = ? WHERE key = ?', (now, key))
+        etag, last_modified, headers, body, stored_at = row
+        return {'etag': etag, 'last_modified': last_modified, 'headers': json.loads(headers), 'body': body,
+                'fresh': self.offline or (self.ttl is not None and now - stored_at < self.ttl)}
+
+    def put(self, key, resp, body=None):
+        """Store a response, or `body` in place of its own. Pages are stored
+        even without validators or a TTL so that --offline can replay them.
+        """
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        headers = {h: resp.headers[h] for h in self.KEPT_HEADERS if h in resp.headers}
+        if body is None:
+            body = resp.text
+        size = len(body.encode('utf-8'))
+        now = time.time()
+        with self._lock, self._db:
+            old = self._db.execute('SELECT size FROM pages WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key, etag, last_modified, json.dumps(headers), body, size, now, now))
+            self._size += size - (old[0] if old else 0)
+            self._evict()
+
+    def touch(self, key):
+        """Mark an entry as just revalidated, restarting its TTL."""
+        with self._lock, self._db:
+            self._db.execute('UPDATE pages SET stored_at = ? WHERE key = ?', (time.time(), key))
+
+    def _evict(self):
+        if self.max_bytes is None or self._size <= self.max_bytes:
+            return
+        rows = self._db.execute('SELECT key, size FROM pages ORDER BY used_at').fetchall()
+        for key, size in rows:
+            if self._size <= self.max_bytes:
+                break
+            self._db.execute('DELETE FROM pages WHERE key = ?', (key,))
+            self._size -= size
+            count('cache_evictions')
+
+    def close(self):
+        self._db.close()
+
+
+def _cached_response(entry):
+    """Build a Response carrying the cached pagination headers for a page
+    served without a request.
+    """
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.headers.update(entry['headers'])
+    return resp
+
+
+_JSON_STRUCTURE = re.compile(r'["{}\[\]]')
+_JSON_STRING_END = re.compile(r'["\\]')
+
+
+def iter_json_array(chunks):
+    """Incrementally decode a JSON array of objects from an iterable of text
+    chunks, yielding each element as soon as its closing brace arrives.
+
+    Only the text of the element being decoded is buffered, so peak memory is
+    about one element rather than the whole array. A light scanner tracks
+    nesting and strings to find where each element ends; the element itself
+    is then decoded with json.loads.
+    """
+    buf = ''
+    pos = 0
+    start = None
+    depth = 0
+    in_string = False
+    started = False
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            if not started:
+                stripped = buf.lstrip()
+                if not stripped:
+                    buf = ''
+                    break
+                if stripped[0] != '[':
+                    raise ValueError('Expected a JSON array')
+                buf = stripped[1:]
+                started = True
+                continue
+            if start is None:
+                # Between elements: skip separators until the next element
+                rest = buf.lstrip(' \t\r\n,')
+                if not rest:
+                    buf = ''
+                    break
+                if rest[0] == ']':
+                    return
+                if rest[0] not in '{[':
+                    raise ValueError('Only arrays of objects or arrays can be streamed')
+                buf = rest
+                start = 0
+                pos = 0
+            if in_string:
+                m = _JSON_STRING_END.search(buf, pos)
+                if m is None:
+                    pos = max(pos, len(buf))
+                    break
+                if m.group() == '\\':
+                    # Skip the escaped character (it may not have arrived yet)
+                    pos = m.end() + 1
+                else:
+                    in_string = False
+                    pos = m.end()
+                continue
+            m = _JSON_STRUCTURE.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            pos = m.end()
+            char = m.group()
+            if char == '"':
+                in_string = True
+            elif char in '{[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    element, buf = buf[:pos], buf[pos:]
+                    start = None
+                    yield json.loads(element)
+    raise ValueError('Unexpected end of JSON array')
+
+
+def _stream_items(resp):
+    """Yield the posts of a streamed listing response one at a time."""
+    decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')()
+
+    def chunks():
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            count('bytes_fetched', len(chunk))
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+
+    try:
+        for item in iter_json_array(chunks()):
+            count('posts_fetched')
+            yield item
+    finally:
+        resp.close()
+
+
+def fetch_posts_page(session, site_api_url, page, per_page=100, auth=None, query=None, cache=None,
+                     route=DEFAULT_ROUTE, stream=False):
+    """Fetch a single page of /wp/v2/posts (or another collection route).
+    Returns (response, items); items is None when the endpoint does not
+    exist. query holds extra request parameters such as _fields. See
+    PageCache for how a cache is used. With stream=True, items is an iterator
+    decoding posts from the response as they arrive (no caching).
+    """
+    url = f"{site_api_url.rstrip('/')}/{route}"
+    params = dict(query or {}, per_page=per_page, page=page)
+    # request edit context when authenticated to get raw source (shortcodes unexpanded)
+    if auth:
+        params['context'] = 'edit'
+    headers = {}
+    entry = None
+    if cache is not None:
+        cache_key = cache.key(url, params, auth)
+        entry = cache.get(cache_key)
+        if entry and entry['fresh']:
+            count('cache_fresh_hits')
+            count('cache_bytes_saved', len(entry['body'].encode('utf-8')))
+            items = json.loads(entry['body'])
+            count('posts_fetched', len(items))
+            return _cached_response(entry), items
+        if cache.offline:
+            raise CacheMiss(f"page {page} of {route} is not in the cache {cache.path} (--offline)")
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    resp = session.get(url, params=params, headers=headers, stream=stream)
+    if resp.status_code == 304 and entry:
+        count('cache_hits')
+        count('cache_bytes_saved', len(entry['body'].encode('utf-8')))
+        cache.touch(cache_key)
+        for name, value in entry['headers'].items():
+            resp.headers.setdefault(name, value)
+        items = json.loads(entry['body'])
+        count('posts_fetched', len(items))
+        return resp, items
+    if resp.status_code == 404:
+        print("API endpoint not found (404). Check the site URL and API base path.")
+        return resp, None
+    if resp.status_code == 400 and page > 1 and resp.json().get('code') == 'rest_post_invalid_page_number':
+        # Past the last page, e.g. when resuming after posts were deleted.
+        # Cached as an empty page so an offline run ends here too.
+        if cache is not None:
+            cache.put(cache_key, resp, body='[]')
+        return resp, []
+    resp.raise_for_status()
+    if stream:
+        return resp, _stream_items(resp)
+    items = resp.json()
+    count('bytes_fetched', len(resp.content))
+    count('posts_fetched', len(items))
+    if cache is not None:
+        count('cache_misses')
+        cache.put(cache_key, resp)
+    return resp, items
+
+
+def get_type_routes(session, site_api_url, types):
+    """Discover the REST routes of post types from /wp/v2/types.
+
+    types is a list of type slugs (e.g. ['post', 'page', 'trip']), or ['all']
+    for every type with a REST route except those in NON_CONTENT_TYPES.
+    Returns {slug: route} where route is e.g. 'wp/v2/pages'. Raises ValueError
+    for a type the site does not expose over REST.
+    """
+    resp = session.get(f"{site_api_url.rstrip('/')}/wp/v2/types")
+    resp.raise_for_status()
+    available = {slug: f"{t.get('rest_namespace') or 'wp/v2'}/{t['rest_base']}"
+                 for slug, t in resp.json().items() if t.get('rest_base')}
+    if 'all' in types:
+        return {slug: route for slug, route in available.items() if slug not in NON_CONTENT_TYPES}
+    missing = [t for t in types if t not in available]
+    if missing:
+        raise ValueError(f"Unknown post type(s): {', '.join(missing)} (available: {', '.join(available)})")
+    return {slug: available[slug] for slug in types}
+
+
+def post_route(post, type_routes):
+    """Return the REST route a post was read from and is written back to."""
+    return type_routes.get(post.get('type'), DEFAULT_ROUTE)
+
+
+def get_posts(site_api_url, per_page=100, auth=None, concurrency=1, session=None, query=None, cache=None,
+              routes=(DEFAULT_ROUTE,), stream=False, journal=None, start_pages=None):
+    """Generator yielding posts from WP REST API /wp/v2/posts?page=N, or from
+    each of the given collection routes (e.g. wp/v2/pages) in turn.
+    Fetches all pages until none left.
+
+    With concurrency > 1 the first page of every route is fetched in parallel
+    and page counts are taken from their X-WP-TotalPages headers; the
+    remaining pages of all routes are then fetched with at most `concurrency`
+    pages in flight. Posts are still yielded in route and page order.
+    Closing the generator early (e.g. when --limit is reached) stops any
+    further pages being scheduled. stream=True decodes each page's posts
+    incrementally (see iter_json_array) instead of loading whole pages.
+    start_pages maps a route to the page to start from (default 1); a
+    RunJournal is told which page each post came from.
+    """
+    if session is None:
+        session = make_session(auth, pool_size=max(concurrency, 1))
+    start_pages = start_pages or {}
+
+    def fetch_page(job):
+        route, page = job
+        resp, items = fetch_posts_page(session, site_api_url, page, per_page=per_page, auth=auth, query=query,
+                                       cache=cache, route=route, stream=stream)
+        if journal is not None and items:
+            items = journal.track(route, page, items)
+        return resp, items
+
+    def probe_page(job):
+        resp, items = fetch_page(job)
+        if stream and resp is not None:
+            # An unread streamed page holds a pooled connection, which would
+            # starve the fetches below; only the headers are needed here.
+            resp.close()
+        return resp, items
+
+    first_pages = {}
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            first_pages = dict(zip(routes, pool.map(probe_page,
+                                                    [(route, start_pages.get(route, 1)) for route in routes])))
+        if all(not items or 'X-WP-TotalPages' in resp.headers for resp, items in first_pages.values()):
+            jobs = []
+            for route, (resp, items) in first_pages.items():
+                if not items:
+                    continue
+                total_pages = int(resp.headers['X-WP-TotalPages'])
+                total_posts = resp.headers.get('X-WP-Total', '?')
+                print(f"Site reports {total_posts} item(s) in {route} over {total_pages} page(s)")
+                jobs.extend((route, page) for page in range(start_pages.get(route, 1), total_pages + 1))
+            print(f"Fetching {concurrency} page(s) at a time")
+        else:
+            jobs = None
+        if stream:
+            # The probes were closed unread; request the first pages again
+            first_pages = {}
+
+        def fetch_job(job):
+            # First pages are already here (unless streaming)
+            if job[0] in first_pages and job[1] == start_pages.get(job[0], 1):
+                return first_pages.pop(job[0])
+            return fetch_page(job)
+
+        if jobs is not None:
+            yield from _fetch_pages_concurrently(fetch_job, jobs, concurrency)
+            return
+
+    for route in routes:
+        yield from _get_pages_sequentially(fetch_page, route, per_page, first_pages.get(route),
+                                           start_pages.get(route, 1))
+
+
+def _get_pages_sequentially(fetch_page, route, per_page, first_page=None, start_page=1):
+    """Yield the items of one route page by page, stopping at the page count
+    from X-WP-TotalPages (or a short page when the header is missing).
+    """
+    page = start_page
+    resp, items = first_page or fetch_page((route, page))
+    while items:
+        n_items = 0
         for p in items:
+            n_items += 1
             yield p
         if 'X-WP-TotalPages' in resp.headers:
             total = int(resp.headers['X-WP-TotalPages'])
@@ -161,19 +897,977 @@ def get_posts(site_api_url, per_page=100, auth=None):
                 break
         else:
             # Heuristic: stop if fewer than per_page items
-            if len(items) < per_page:
+            if n_items < per_page:
                 break
         page += 1
+        resp, items = fetch_page((route, page))
+
+
+def _fetch_pages_concurrently(fetch_page, pages, concurrency):
+    """Fetch pages with a sliding window of `concurrency` requests and yield
+    their items in page order. A new page is only scheduled when an earlier
+    one has been consumed, so an abandoned generator stops fetching promptly.
+    """
+    pages = iter(pages)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        pending = deque(pool.submit(fetch_page, page) for page in itertools.islice(pages, concurrency))
+        try:
+            while pending:
+                _resp, items = pending.popleft().result()
+                next_page = next(pages, None)
+                if next_page is not None:
+                    pending.append(pool.submit(fetch_page, next_page))
+                for p in items or ():
+                    yield p
+        finally:
+            for future in pending:
+                future.cancel()
 
 
 import json
-def update_post(site_api_url, post_id, new_content, auth):
-    url = f"{site_api_url.rstrip('/')}/wp/v2/posts/{post_id}"
-    resp = requests.post(url, json={'content': new_content}, auth=auth)
+WXR_CONTENT_NS = '{http://purl.org/rss/1.0/modules/content/}'
+WXR_WP_NS_PREFIX = '{http://wordpress.org/export/'
+
+
+def _wxr_field(tag):
+    """Map a WXR <item> child tag to a short field name, or None if unused.
+    The wp: namespace URI carries the export version, so it is matched by prefix.
+    """
+    if tag == WXR_CONTENT_NS + 'encoded':
+        return 'content'
+    if tag in ('title', 'link', 'guid'):
+        return tag
+    if tag.startswith(WXR_WP_NS_PREFIX):
+        name = tag.rsplit('}', 1)[1]
+        if name in ('post_id', 'post_name', 'post_type', 'status', 'post_modified_gmt'):
+            return name
+    return None
+
+
+def get_wxr_posts(path, post_types=('post',), statuses=('publish',)):
+    """Generator yielding posts from a WordPress export (WXR) file in the same
+    shape as get_posts. The file is parsed incrementally and each <item> is
+    discarded once yielded, so memory use does not grow with the export size.
+    post_types=None selects every type not in NON_CONTENT_TYPES.
+    """
+    channel = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if channel is None and elem.tag == 'channel':
+                channel = elem
+            continue
+        if elem.tag != 'item':
+            continue
+        fields = {}
+        for child in elem:
+            name = _wxr_field(child.tag)
+            if name:
+                fields[name] = child.text or ''
+        # Items are children of <channel>: drop the parsed item (and anything
+        # before it) from there, or the whole export stays in the tree
+        elem.clear()
+        if channel is not None:
+            channel.clear()
+        post_type = fields.get('post_type')
+        if post_types is None:
+            if post_type in NON_CONTENT_TYPES:
+                continue
+        elif post_type not in post_types:
+            continue
+        if fields.get('status') not in statuses:
+            continue
+        yield {
+            'id': int(fields.get('post_id') or 0),
+            'type': post_type,
+            'link': fields.get('link', ''),
+            'slug': fields.get('post_name', ''),
+            'guid': {'rendered': fields.get('guid', '')},
+            'title': {'rendered': fields.get('title', '')},
+            'content': {'raw': fields.get('content', '')},
+            # WXR writes '2021-01-31 10:00:00'; the REST API '2021-01-31T10:00:00'
+            'modified_gmt': fields.get('post_modified_gmt', '').replace(' ', 'T'),
+        }
+
+
+def verify_prefilter(candidates, all_posts, site, engine='bs4', formats=DEFAULT_FORMATS):
+    """Compare the posts returned by a server-side search prefilter against a
+    full scan. Returns (candidate_keys, matched_keys, missed_keys): the posts
+    the search returned, the posts of the full scan that have track links
+    (found as find_gpx_links does with engine and formats), and those of them
+    the search did not return. Posts are keyed by (type, id).
+    """
+    def key(post):
+        return post.get('type', 'post'), post.get('id')
+
+    candidate_keys = {key(post) for post in candidates}
+    matched_keys = set()
+    for post in all_posts:
+        content, _is_source = get_post_content(post)
+        if find_gpx_links(content, site, engine=engine, formats=formats):
+            matched_keys.add(key(post))
+    return candidate_keys, matched_keys, matched_keys - candidate_keys
+
+
+def compare_engines(posts, site, engines=tuple(DETECTION_ENGINES), formats=DEFAULT_FORMATS):
+    """Run every detection engine over the posts' content. Returns
+    (seconds per engine, ids of posts where an engine disagreed with the
+    first one).
+    """
+    timings = dict.fromkeys(engines, 0.0)
+    mismatches = []
+    for post in posts:
+        count('posts_compared')
+        content, _is_source = get_post_content(post)
+        found = []
+        for engine in engines:
+            start = time.perf_counter()
+            links = find_gpx_links(content, site, engine=engine, formats=formats)
+            timings[engine] += time.perf_counter() - start
+            found.append([(anchor.start, anchor.end, url, title) for anchor, url, title in links])
+        if any(links != found[0] for links in found[1:]):
+            mismatches.append(post.get('id'))
+    return timings, mismatches
+
+
+def load_state(path):
+    """Load the incremental-scan state file (a JSON object keyed by API base)."""
+    import os
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def save_state(path, state):
+    """Write the state file atomically so an interrupted run can't corrupt it."""
+    import os
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        json.dump(state, fh, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def advance_cursor(cursor, post):
+    """Record post in the incremental cursor (a dict with 'modified_after').
+    WordPress filters modified_after against the site-local `modified` column,
+    so that is the value tracked as the high-water mark.
+    """
+    if cursor is not None and post.get('modified', '') > cursor.get('modified_after', ''):
+        cursor['modified_after'] = post['modified']
+
+
+class RunJournal:
+    """Append-only journal (JSON lines) of a live run, so an interrupted run
+    can be continued with --resume instead of starting over.
+
+    Every page read is recorded with the ids of its posts ('fetched'); each
+    post is recorded as 'transformed' before it is written and as 'written',
+    or 'skipped' when it needs no change, once finished; a page is recorded
+    as 'done' when all of its posts are finished. Lines are flushed as they
+    are written but fsynced in batches (every sync_every records or
+    sync_interval seconds, and on close). A torn last line left by a crash
+    is ignored when resuming.
+    """
+
+    FINISHED = ('written', 'skipped')
+
+    def __init__(self, path, resume=False, sync_every=100, sync_interval=1.0):
+        import os
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.finished = set()
+        self.done_pages = set()
+        if resume and os.path.exists(path):
+            self._load()
+        self._fh = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+        # (route, page) -> [ids not finished yet, whole page fetched]
+        self._pages = {}
+        self._post_pages = {}
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'page' in record:
+                    if record['state'] == 'done':
+                        self.done_pages.add((record['route'], record['page']))
+                elif record['state'] in self.FINISHED:
+                    self.finished.add(record['id'])
+
+    def start_page(self, route):
+        """Return the first page of route not completed by an earlier run."""
+        page = 1
+        while (route, page) in self.done_pages:
+            page += 1
+        return page
+
+    def track(self, route, page, items):
+        """Yield the posts of a fetched page, noting which page each is on."""
+        key = (route, page)
+        ids = []
+        with self._lock:
+            self._pages[key] = [set(), False]
+        for post in items:
+            post_id = post.get('id')
+            with self._lock:
+                self._pages[key][0].add(post_id)
+                self._post_pages.setdefault(post_id, set()).add(key)
+            ids.append(post_id)
+            yield post
+        with self._lock:
+            self._append({'route': route, 'page': page, 'state': 'fetched', 'ids': ids})
+            self._pages[key][1] = True
+            self._page_progress(key)
+
+    def resumed(self, post):
+        """Return True (and count the post towards its page) if post was
+        finished by an earlier run.
+        """
+        if post.get('id') not in self.finished:
+            return False
+        count('posts_resumed')
+        self.record(post, 'skipped')
+        return True
+
+    def record(self, post, state):
+        post_id = post.get('id')
+        with self._lock:
+            if state not in self.FINISHED:
+                self._append({'id': post_id, 'state': state})
+                return
+            if post_id not in self.finished:
+                self._append({'id': post_id, 'state': state})
+                self.finished.add(post_id)
+            for key in self._post_pages.pop(post_id, ()):
+                self._pages[key][0].discard(post_id)
+                self._page_progress(key)
+
+    def _page_progress(self, key):
+        pending, fetched = self._pages[key]
+        if fetched and not pending:
+            del self._pages[key]
+            self.done_pages.add(key)
+            self._append({'route': key[0], 'page': key[1], 'state': 'done'})
+
+    def _append(self, record):
+        import os
+        self._fh.write(json.dumps(record) + '\n')
+        self._fh.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every or time.monotonic() - self._synced_at >= self.sync_interval:
+            os.fsync(self._fh.fileno())
+            self._unsynced = 0
+            self._synced_at = time.monotonic()
+
+    def close(self):
+        import os
+        with self._lock:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+
+
+def http_date(modified_gmt):
+    """Format a REST API modified_gmt value ('2021-01-31T10:00:00') as an HTTP date."""
+    modified = datetime.strptime(modified_gmt, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    return format_datetime(modified, usegmt=True)
+
+
+def update_post(site_api_url, post_id, new_content, auth, fields=UPDATE_FIELDS, route=DEFAULT_ROUTE, session=None,
+                if_unmodified_since=None):
+    url = f"{site_api_url.rstrip('/')}/{route}/{post_id}"
+    params = {'_fields': fields} if fields else None
+    # Honoured by servers/proxies that support conditional writes (412 if the post changed)
+    headers = {'If-Unmodified-Since': http_date(if_unmodified_since)} if if_unmodified_since else None
+    resp = (session or requests).post(url, params=params, headers=headers, json={'content': new_content}, auth=auth)
     resp.raise_for_status()
     return resp.json()
 
 
+def find_stale_posts(session, site_api_url, posts, type_routes):
+    """Return the ids of posts whose modified_gmt on the site differs from the
+    value they were read with (or that are no longer listed). Only ids and
+    timestamps are requested: one small listing per route and 100 posts.
+    Posts read without a modified_gmt are not checked.
+    """
+    by_route = {}
+    for post in posts:
+        if post.get('modified_gmt'):
+            by_route.setdefault(post_route(post, type_routes), []).append(post)
+    stale = set()
+    for route, route_posts in by_route.items():
+        for i in range(0, len(route_posts), 100):
+            chunk = route_posts[i:i + 100]
+            params = {'include': ','.join(str(post['id']) for post in chunk), 'per_page': len(chunk),
+                      'status': 'any', '_fields': 'id,modified_gmt'}
+            resp = session.get(f"{site_api_url.rstrip('/')}/{route}", params=params)
+            resp.raise_for_status()
+            current = {item['id']: item.get('modified_gmt') for item in resp.json()}
+            stale.update(post['id'] for post in chunk if current.get(post['id']) != post['modified_gmt'])
+    return stale
+
+
+def refresh_post(session, site_api_url, post, type_routes, site, fields=None, engine='bs4',
+                 formats=DEFAULT_FORMATS, merge=False):
+    """Re-read a post that changed since it was fetched and transform its
+    current version. Returns (post, new_content), or None when the current
+    version needs no change.
+    """
+    params = {'context': 'edit'}
+    if fields:
+        params['_fields'] = fields
+    resp = session.get(f"{site_api_url.rstrip('/')}/{post_route(post, type_routes)}/{post['id']}", params=params)
+    resp.raise_for_status()
+    fresh = resp.json()
+    content, _is_source = get_post_content(fresh)
+    new_content, link_matches = transform_post(fresh, content, site, engine=engine, formats=formats, merge=merge)
+    if not link_matches or new_content == content:
+        return None
+    return fresh, new_content
+
+
+def get_batch_size(session, site_api_url):
+    """Return the maximum number of requests the site accepts per /batch/v1
+    call, or None when it has no batch endpoint (WordPress before 5.6).
+    """
+    resp = session.options(f"{site_api_url.rstrip('/')}/batch/v1")
+    if resp.status_code != 200:
+        return None
+    try:
+        return int(resp.json()['endpoints'][0]['args']['requests']['maxItems'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        # The endpoint exists but doesn't describe itself; use WordPress' default
+        return 25
+
+
+class PostWriter:
+    """Writes updated posts back to the site and prints the outcome of each.
+
+    By default every post is written with its own request as soon as it is
+    given to write(). With workers > 1, writes run on a thread pool sharing
+    the session's keep-alive connections; write() blocks once 2 * workers
+    writes are waiting so memory stays bounded. With a batch_size, posts are
+    queued and sent in groups through the /batch/v1 endpoint; items that fail
+    with a retryable status are queued again (up to max_attempts) and other
+    failures are reported. If the site turns out not to support batching,
+    writes fall back to single requests. Call close() at the end of the run
+    to wait for outstanding writes and flush the queue.
+
+    With a `refresh` callable, writes guard against overwriting edits made
+    since the post was read: before each batch, or each CHECK_GROUP single
+    writes (held back until that many are waiting), find_stale_posts compares
+    modified_gmt values with one request, and writes also carry
+    If-Unmodified-Since.
+    Only posts that did change are passed to refresh(post), which returns
+    (post, new_content) for the current version, or None to skip it.
+    Finished posts are recorded in `journal` (a RunJournal) when given.
+    """
+
+    # Single writes checked for conflicts together (one find_stale_posts listing)
+    CHECK_GROUP = 100
+
+    def __init__(self, session, site_api_url, type_routes, batch_size=None, max_attempts=3, workers=1,
+                 refresh=None, journal=None):
+        self.session = session
+        self.site_api_url = site_api_url.rstrip('/')
+        self.type_routes = type_routes
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._queue = []
+        self._pending = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._slots = threading.BoundedSemaphore(2 * workers)
+        self.refresh = refresh
+        self.journal = journal
+
+    def write(self, post, new_content):
+        if self.refresh is not None and not self.batch_size:
+            with self._lock:
+                self._pending.append((post, new_content, 1))
+                if len(self._pending) < self.CHECK_GROUP:
+                    return
+                group, self._pending = self._pending, []
+            self._dispatch(group)
+            return
+        self._submit(post, new_content)
+
+    def _submit(self, post, new_content):
+        if self._pool is None:
+            self._write(post, new_content)
+            return
+        self._slots.acquire()
+        future = self._pool.submit(self._write, post, new_content)
+        future.add_done_callback(lambda _future: self._slots.release())
+
+    def _dispatch(self, group):
+        """Check a group of pending single writes for conflicts and send them."""
+        with stage_timer('write'):
+            group = self._resolve_conflicts(group)
+        for post, new_content, _attempt in group:
+            self._submit(post, new_content)
+
+    def close(self):
+        with self._lock:
+            group, self._pending = self._pending, []
+        if group:
+            self._dispatch(group)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        while True:
+            with self._lock:
+                batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+            if not batch:
+                return
+            with stage_timer('write'):
+                self._send_batch(batch)
+
+    def _write(self, post, new_content):
+        if not self.batch_size:
+            with stage_timer('write'):
+                self._write_one(post, new_content)
+            return
+        batch = None
+        with self._lock:
+            self._queue.append((post, new_content, 1))
+            if len(self._queue) >= self.batch_size:
+                batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+        if batch:
+            with stage_timer('write'):
+                self._send_batch(batch)
+
+    def _resolve_conflicts(self, items):
+        """Return items ((post, new_content, attempt) tuples) with the posts
+        that changed on the site since they were read re-transformed or
+        dropped.
+        """
+        if self.refresh is None:
+            return items
+        try:
+            stale = find_stale_posts(self.session, self.site_api_url, [item[0] for item in items], self.type_routes)
+        except requests.RequestException as e:
+            self._fail_all(items, f"could not check for conflicting edits: {e}")
+            return []
+        resolved = []
+        for post, new_content, attempt in items:
+            if post.get('id') in stale:
+                replacement = self._refresh(post)
+                if replacement is None:
+                    continue
+                post, new_content = replacement
+            resolved.append((post, new_content, attempt))
+        return resolved
+
+    def _refresh(self, post):
+        post_id = post.get('id')
+        count('conflicts')
+        try:
+            replacement = self.refresh(post)
+        except Exception as e:
+            count('update_failures')
+            log(f"Failed to update post {post_id}: it changed since it was read and could not be re-read: {e}")
+            return None
+        if replacement is None:
+            log(f"Post {post_id} changed since it was read and no longer needs updating")
+            if self.journal is not None:
+                self.journal.record(post, 'skipped')
+        else:
+            count('conflicts_reapplied')
+            log(f"Post {post_id} changed since it was read; shortcodes re-applied to the current version")
+        return replacement
+
+    def _write_one(self, post, new_content, check=True):
+        post_id = post.get('id')
+        unmodified_since = post.get('modified_gmt') if self.refresh and check else None
+        try:
+            update_post(self.site_api_url, post_id, new_content, None, route=post_route(post, self.type_routes),
+                        session=self.session, if_unmodified_since=unmodified_since)
+            self._written(post)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 412 and check:
+                replacement = self._refresh(post)
+                if replacement is not None:
+                    self._write_one(*replacement, check=False)
+                return
+            count('update_failures')
+            log(f"Failed to update post {post_id}: {e}")
+        except Exception as e:
+            count('update_failures')
+            log(f"Failed to update post {post_id}: {e}")
+
+    def _send_batch(self, batch):
+        batch = self._resolve_conflicts(batch)
+        if not batch:
+            return
+        body = {'requests': []}
+        for post, new_content, _attempt in batch:
+            request = {'method': 'POST',
+                       'path': f"/{post_route(post, self.type_routes)}/{post.get('id')}?_fields={UPDATE_FIELDS}",
+                       'body': {'content': new_content}}
+            if self.refresh and post.get('modified_gmt'):
+                request['headers'] = {'If-Unmodified-Since': http_date(post['modified_gmt'])}
+            body['requests'].append(request)
+        try:
+            resp = self.session.post(f"{self.site_api_url}/batch/v1", json=body)
+        except requests.RequestException as e:
+            self._fail_all(batch, e)
+            return
+        if resp.status_code in (404, 405):
+            log("Batch endpoint not available; writing posts one at a time")
+            self.batch_size = None
+            for post, new_content, _attempt in batch:
+                self._write_one(post, new_content)
+            return
+        try:
+            resp.raise_for_status()
+            responses = resp.json()['responses']
+        except (requests.RequestException, ValueError, KeyError) as e:
+            self._fail_all(batch, e)
+            return
+        count('batch_requests')
+        retry = []
+        for (post, new_content, attempt), result in zip(batch, responses):
+            post_id = post.get('id')
+            status = result.get('status', 0)
+            if 200 <= status < 300:
+                count('batch_items_written')
+                self._written(post)
+            elif status == 412 and self.refresh and attempt < self.max_attempts:
+                replacement = self._refresh(post)
+                if replacement is not None:
+                    retry.append(replacement + (attempt + 1,))
+            elif (status >= 500 or status in RetryPolicy.RETRY_STATUSES) and attempt < self.max_attempts:
+                count('batch_items_retried')
+                retry.append((post, new_content, attempt + 1))
+            else:
+                message = (result.get('body') or {}).get('message') or f"HTTP {status}"
+                count('update_failures')
+                log(f"Failed to update post {post_id}: {message}")
+        if retry:
+            with self._lock:
+                self._queue[:0] = retry
+
+    def _written(self, post):
+        count('posts_written')
+        log(f"Updated post {post.get('id')}")
+        if self.journal is not None:
+            self.journal.record(post, 'written')
+
+    def _fail_all(self, batch, error):
+        for post, _new_content, _attempt in batch:
+            count('update_failures')
+            log(f"Failed to update post {post.get('id')}: {error}")
+
+
+def get_post_content(post):
+    """Return (content, is_source) for a post. Source/raw content is used when
+    available (requires authenticated edit context); otherwise the rendered
+    content is returned, in which shortcodes will already be expanded.
+    """
+    content_obj = post.get('content', {})
+    if 'raw' in content_obj:
+        return content_obj.get('raw') or content_obj.get('rendered', ''), True
+    return content_obj.get('rendered', ''), False
+
+
+def merged_shortcode(post_url, link_matches):
+    """Return one shortcode mapping the files of all link_matches, each track
+    in the next TRACK_COLOURS colour.
+    """
+    relpaths = [compute_relative_path(file_url, post_url) for _anchor, file_url, _title in link_matches]
+    # The plugin splits these lists on commas
+    titles = [re.sub(r'\s*,\s*', ' ', title) for _anchor, _url, title in link_matches]
+    colours = itertools.islice(itertools.cycle(TRACK_COLOURS), len(link_matches))
+    return MERGED_SHORTCODE_TPL.format(relpaths=','.join(relpaths), colours=','.join(colours), titles=','.join(titles))
+
+
+def apply_shortcodes(post, content, link_matches, site, merge=False):
+    """Insert a shortcode before each link found by find_gpx_links and return
+    the new content. Insertion points are found from the links' offsets in
+    one pass and applied in one splice, leaving all other markup untouched.
+    In block editor content a link's shortcode is added as a wp:shortcode
+    block before the paragraph block holding the link, so blocks stay valid.
+    With merge=True a post with several links gets a single map of all of
+    them (see merged_shortcode), placed before the first link.
+    """
+    post_url = post.get('link') or post.get('guid', {}).get('rendered', site)
+    link_matches = sorted(link_matches, key=lambda match: match[0].start)
+    offsets = [anchor.start for anchor, _url, _title in link_matches]
+    if merge and len(link_matches) > 1:
+        shortcodes = [merged_shortcode(post_url, link_matches)]
+        offsets = offsets[:1]
+    else:
+        shortcodes = [TRACK_RULES[track_format(file_url)].format(relpath=compute_relative_path(file_url, post_url),
+                                                                 title=file_title)
+                      for _anchor, file_url, file_title in link_matches]
+    points = insertion_points(content, offsets)
+    block_points = block_insertion_points(content, offsets) if '<!-- wp:' in content else [None] * len(offsets)
+    inserts = []
+    for point, block_point, sc in zip(points, block_points, shortcodes):
+        if block_point is None:
+            inserts.append((point, sc))
+        else:
+            inserts.append((block_point, SHORTCODE_BLOCK_TPL.format(shortcode=sc)))
+    return splice(content, inserts)
+
+
+def transform_post(post, content, site, engine='bs4', formats=DEFAULT_FORMATS, merge=False):
+    """Insert a shortcode before every track link in content (or one for
+    all of them with merge=True). Returns (new_content, link_matches).
+    """
+    link_matches = find_gpx_links(content, site, engine=engine, formats=formats)
+    return apply_shortcodes(post, content, link_matches, site, merge), link_matches
+
+
+def transform_posts(posts, site, engine='bs4', formats=DEFAULT_FORMATS, merge=False, workers=1, chunk_size=20):
+    """Yield (post, content, is_source, new_content, link_matches) for each
+    post, in order. With workers > 1 the transforms run on a pool of that
+    many processes: posts go in chunks of chunk_size, carrying only their
+    content and URLs, with at most 2 * workers chunks in flight; unchanged
+    content is not sent back.
+    """
+    if workers <= 1:
+        for post in posts:
+            content, is_source = get_post_content(post)
+            yield (post, content, is_source) + transform_post(post, content, site, engine, formats, merge)
+        return
+
+    def chunks():
+        post_iter = iter(posts)
+        while True:
+            chunk = [(post,) + get_post_content(post) for post in itertools.islice(post_iter, chunk_size)]
+            if not chunk:
+                return
+            yield chunk
+
+    def submit(chunk):
+        tasks = [({key: post[key] for key in ('link', 'guid') if key in post}, content) for post, content, _ in chunk]
+        return chunk, pool.submit(_transform_chunk, site, engine, formats, merge, tasks)
+
+    chunk_iter = chunks()
+    # spawn, not fork: the writer threads may hold locks at the time
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        pending = deque(submit(chunk) for chunk in itertools.islice(chunk_iter, 2 * workers))
+        try:
+            while pending:
+                chunk, future = pending.popleft()
+                results, counted = future.result()
+                with _metrics_lock:
+                    metrics.update(counted)
+                next_chunk = next(chunk_iter, None)
+                if next_chunk is not None:
+                    pending.append(submit(next_chunk))
+                for (post, content, is_source), (new_content, link_matches) in zip(chunk, results):
+                    yield post, content, is_source, content if new_content is None else new_content, link_matches
+        finally:
+            for _chunk, future in pending:
+                future.cancel()
+
+
+def _transform_chunk(site, engine, formats, merge, tasks):
+    """Process pool task for transform_posts. Returns the results (new
+    content is None when unchanged) and the metrics counted meanwhile, for
+    the parent process to add to its own.
+    """
+    before, url_before = Counter(metrics), url_cache_counts()
+    results = []
+    for post, content in tasks:
+        new_content, link_matches = transform_post(post, content, site, engine, formats, merge)
+        results.append((None if new_content == content else new_content, link_matches))
+    return results, (metrics - before) + (url_cache_counts() - url_before)
+
+
+def write_preview(preview_dir, post, content, new_content):
+    """Write before/after preview files: preview/<post_id>-<slug>-before.html and -after.html"""
+    import os
+    post_id = post.get('id')
+    slug = post.get('slug') or str(post_id)
+    before_path = os.path.join(preview_dir, f"{post_id}-{slug}-before.html")
+    after_path = os.path.join(preview_dir, f"{post_id}-{slug}-after.html")
+    try:
+        with open(before_path, 'w', encoding='utf-8') as fh:
+            fh.write(content)
+        with open(after_path, 'w', encoding='utf-8') as fh:
+            fh.write(new_content)
+        print(f"Wrote preview for post {post_id} to {before_path} and {after_path}")
+    except Exception as e:
+        print(f"Failed to write preview for post {post_id}: {e}")
+
+
+def report_post(args, preview_dir, post, content, new_content, link_matches, updates):
+    """Print the outcome for a post with track links and record it in updates.
+    Handles --dry-run and --preview; returns True when new_content still has
+    to be written to the site.
+    """
+    post_id = post.get('id')
+    title = post.get('title', {}).get('rendered', '')
+    log(f"Found {len(link_matches)} track link(s) in post {post_id}: {title}")
+    if new_content == content:
+        return False
+    # Only ids are kept so memory stays flat however many posts change
+    updates.append({'post_id': post_id, 'title': title})
+    if args.dry_run:
+        log(f"DRY RUN - would update post {post_id} ({title})")
+        return False
+    if args.preview:
+        write_preview(preview_dir, post, content, new_content)
+        return False
+    log(f"Updating post {post_id} ({title})...")
+    return True
+
+
+async def run_async(args, site, read_page, write_post, preview_dir, routes=(DEFAULT_ROUTE,), per_page=50,
+                    cursor=None):
+    """asyncio engine: page reads, transforms and post writes are pipelined
+    over one event loop. read_page(page, route=...) and write_post(post,
+    new_content) (which reports its own outcome) are blocking calls; they run
+    on an I/O thread pool with at most args.concurrency requests (reads and
+    writes together) in flight. The CPU-bound HTML transforms run on a
+    separate executor so they never block the loop. Returns
+    (posts_processed, updates) like the synchronous loop.
+    """
+    loop = asyncio.get_running_loop()
+    concurrency = max(args.concurrency, 1)
+    inflight = asyncio.Semaphore(concurrency)
+    io_pool = ThreadPoolExecutor(max_workers=concurrency)
+    cpu_pool = ThreadPoolExecutor(max_workers=1)
+    posts_processed = 0
+    updates = []
+    writes = []
+
+    async def call_io(fn, *fn_args, **fn_kwargs):
+        async with inflight:
+            return await loop.run_in_executor(io_pool, functools.partial(fn, *fn_args, **fn_kwargs))
+
+    def fetch(route, page):
+        return asyncio.ensure_future(call_io(read_page, page, route=route))
+
+    page_iter = _aiter_pages(fetch, routes, per_page, concurrency)
+    try:
+        async for items in page_iter:
+            transforms = []
+            for post in items:
+                content, is_source = get_post_content(post)
+                transforms.append((post, content, is_source,
+                                   loop.run_in_executor(cpu_pool, transform_post, post, content, site,
+                                                        args.detect_engine, args.formats, args.merge_tracks)))
+            for post, content, is_source, transform in transforms:
+                if args.limit and posts_processed >= args.limit:
+                    return posts_processed, updates
+                if not is_source:
+                    print(RENDERED_CONTENT_WARNING)
+                new_content, link_matches = await transform
+                advance_cursor(cursor, post)
+                if not link_matches:
+                    continue
+                if report_post(args, preview_dir, post, content, new_content, link_matches, updates):
+                    writes.append(asyncio.ensure_future(call_io(write_post, post, new_content)))
+                posts_processed += 1
+        return posts_processed, updates
+    finally:
+        await page_iter.aclose()
+        await asyncio.gather(*writes)
+        io_pool.shutdown()
+        cpu_pool.shutdown()
+
+
+async def _aiter_pages(fetch, routes, per_page, concurrency):
+    """Async counterpart of get_posts: yields the item list of each page, in
+    route and page order, keeping up to `concurrency` page fetches running
+    ahead of the consumer.
+    """
+    first_pages = await asyncio.gather(*(fetch(route, 1) for route in routes))
+    if not all(not items or 'X-WP-TotalPages' in resp.headers for resp, items in first_pages):
+        # Without page counts, read each route page by page until a short page
+        for route, (resp, items) in zip(routes, first_pages):
+            page = 1
+            while items:
+                yield items
+                if len(items) < per_page:
+                    break
+                page += 1
+                resp, items = await fetch(route, page)
+        return
+
+    loop = asyncio.get_running_loop()
+    jobs = []
+    for route, first in zip(routes, first_pages):
+        resp, items = first
+        if not items:
+            continue
+        total_pages = int(resp.headers['X-WP-TotalPages'])
+        if concurrency > 1:
+            print(f"Site reports {resp.headers.get('X-WP-Total', '?')} item(s) in {route} over {total_pages} page(s)")
+        done = loop.create_future()
+        done.set_result(first)
+        jobs.append(done)
+        jobs.extend((route, page) for page in range(2, total_pages + 1))
+    if concurrency > 1:
+        print(f"Fetching {concurrency} page(s) at a time")
+
+    jobs = iter(jobs)
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < concurrency:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending.append(job if isinstance(job, asyncio.Future) else fetch(*job))
+            if not pending:
+                break
+            _resp, items = await pending.popleft()
+            if items:
+                yield items
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+_STOP = object()
+
+
+def run_pipeline(args, site, posts, writer, preview_dir, cursor=None, journal=None):
+    """Staged engine: fetch -> detect -> transform -> write.
+
+    Fetching (one thread iterating `posts`, which may fetch pages in parallel
+    itself), link detection (args.detect_workers threads) and shortcode
+    insertion (args.transform_workers threads) each run on their own threads
+    and hand posts on through queues of at most args.queue_size items, so a
+    slow stage holds back the ones before it and the number of posts in
+    memory stays capped. Writes go through `writer` (see --write-workers).
+    Posts are reported in completion order, and recorded in `journal` (a
+    RunJournal) when given. Returns (posts_processed, updates).
+    If a stage fails, the others stop taking new work but keep draining
+    their queues so nothing blocks, and the first error is re-raised once
+    every thread has finished.
+    """
+    detect_q = queue.Queue(maxsize=args.queue_size)
+    transform_q = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    lock = threading.Lock()
+    state = {'processed': 0, 'detect_running': args.detect_workers}
+    updates = []
+    errors = []
+
+    def fail(error):
+        with lock:
+            errors.append(error)
+        stop.set()
+
+    def fetch_stage():
+        try:
+            post_iter = iter(posts)
+            while not stop.is_set():
+                with stage_timer('fetch'):
+                    post = next(post_iter, None)
+                if post is None:
+                    break
+                advance_cursor(cursor, post)
+                if journal is not None and journal.resumed(post):
+                    continue
+                detect_q.put(post)
+        except Exception as e:
+            fail(e)
+        finally:
+            if hasattr(posts, 'close'):
+                posts.close()
+            for _ in range(args.detect_workers):
+                detect_q.put(_STOP)
+
+    def detect_stage():
+        try:
+            while True:
+                post = detect_q.get()
+                if post is _STOP:
+                    break
+                if stop.is_set():
+                    continue
+                try:
+                    detect(post)
+                except Exception as e:
+                    fail(e)
+        finally:
+            with lock:
+                state['detect_running'] -= 1
+                last = state['detect_running'] == 0
+            if last:
+                for _ in range(args.transform_workers):
+                    transform_q.put(_STOP)
+
+    def detect(post):
+        with stage_timer('detect'):
+            content, is_source = get_post_content(post)
+            link_matches = find_gpx_links(content, site, engine=args.detect_engine, formats=args.formats)
+        if not is_source:
+            log(RENDERED_CONTENT_WARNING)
+        if link_matches:
+            transform_q.put((post, content, link_matches))
+        elif journal is not None:
+            journal.record(post, 'skipped')
+
+    def transform_stage():
+        while True:
+            item = transform_q.get()
+            if item is _STOP:
+                break
+            if stop.is_set():
+                continue
+            try:
+                transform(*item)
+            except Exception as e:
+                fail(e)
+
+    def transform(post, content, link_matches):
+        with stage_timer('transform'):
+            new_content = apply_shortcodes(post, content, link_matches, site, args.merge_tracks)
+        with lock:
+            if args.limit and state['processed'] >= args.limit:
+                stop.set()
+                return
+            needs_write = report_post(args, preview_dir, post, content, new_content, link_matches, updates)
+            state['processed'] += 1
+        if journal is not None:
+            journal.record(post, 'transformed' if needs_write else 'skipped')
+        if needs_write:
+            writer.write(post, new_content)
+
+    stages = {'fetch': 1, 'detect': args.detect_workers, 'transform': args.transform_workers}
+    started = time.perf_counter()
+    threads = [threading.Thread(target=fetch_stage)]
+    threads += [threading.Thread(target=detect_stage) for _ in range(args.detect_workers)]
+    threads += [threading.Thread(target=transform_stage) for _ in range(args.transform_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Posts already handed to the writer are still written
+    writer.close()
+    if errors:
+        raise errors[0]
+    elapsed = time.perf_counter() - started
+
+    usage = [f"{name} {100 * metrics[f'busy_{name}'] / (workers * elapsed):.0f}% ({workers} thread(s))"
+             for name, workers in stages.items()]
+    if args.write_workers > 1:
+        usage.append(f"write {100 * metrics['busy_write'] / (args.write_workers * elapsed):.0f}% "
+                     f"({args.write_workers} thread(s))")
+    else:
+        # Without a write pool, writes run inline on the transform threads
+        usage.append(f"write {100 * metrics['busy_write'] / (args.transform_workers * elapsed):.0f}% "
+                     f"(on the {args.transform_workers} transform thread(s))")
+    print(f"Stage utilisation over {elapsed:.1f}s: {', '.join(usage)}")
+    return state['processed'], updates
+
+
 def main():
     parser = argparse.ArgumentParser(description='Find GPX links in WP posts and add OSM shortcode')
     parser.add_argument('site', help='Site base URL, e.g. http://david.currie.name or https://example.com/wp-json')
@@ -182,7 +1876,60 @@ def main():
     parser.add_argument('--dry-run', help='Show changes but do not update posts', action='store_true')
     parser.add_argument('--limit', type=int, help='Limit number of posts to process', default=None)
     parser.add_argument('--preview', help='Write updated HTML to local preview/ directory instead of updating site', action='store_true')
+    parser.add_argument('--wxr', help='Read posts from a WordPress export (WXR) file instead of the REST API', default=None)
+    parser.add_argument('--types', help='Comma-separated post types to scan, e.g. post,page,trip, or "all" (default: post)', default=None)
+    parser.add_argument('--prefilter', help='Ask WordPress to search for candidate posts first (see --prefilter-term)', action='store_true')
+    parser.add_argument('--prefilter-term', help='Search term for --prefilter, e.g. .gpx or an upload path like uploads/2013 (default: .gpx)', default='.gpx')
+    parser.add_argument('--verify-prefilter', help='Compare the --prefilter candidates against a full scan and report any missed posts', action='store_true')
+    parser.add_argument('--concurrency', type=int, help='Number of post pages to fetch in parallel (default: 1)', default=1)
+    parser.add_argument('--write-workers', type=int, help='Number of post updates to send in parallel (default: 1)', default=1)
+    parser.add_argument('--pool-size', type=int, help='HTTP connection pool size (default: --concurrency plus --write-workers; see --stream-json)', default=None)
+    parser.add_argument('--max-retries', type=int, help='Retries per request on 429/502/503/504 or connection errors (default: 5)', default=5)
+    parser.add_argument('--retry-budget', type=int, help='Maximum retries over the whole run (default: unlimited)', default=None)
+    parser.add_argument('--batch', help='Send updates in groups through the /batch/v1 endpoint (falls back to single writes)', action='store_true')
+    parser.add_argument('--check-conflicts', help='Before writing, check whether posts were edited since they were read and re-apply shortcodes to the current version', action='store_true')
+    parser.add_argument('--engine', choices=('sync', 'async', 'pipeline'), default='sync',
+                        help='sync: fetch, transform and update one post at a time; async: pipeline reads and writes on an event loop; '
+                             'pipeline: run fetch, detect, transform and write as separate stages (default: sync)')
+    parser.add_argument('--workers', type=int, help='Processes finding links and inserting shortcodes in parallel (default: 1)', default=1)
+    parser.add_argument('--detect-workers', type=int, help='Link detection threads for --engine pipeline (default: 2)', default=2)
+    parser.add_argument('--transform-workers', type=int, help='Shortcode insertion threads for --engine pipeline (default: 2)', default=2)
+    parser.add_argument('--queue-size', type=int, help='Posts queued between --engine pipeline stages (default: 100)', default=100)
+    parser.add_argument('--incremental', help='Only scan posts modified since the last live run (cursor kept in --state-file)', action='store_true')
+    parser.add_argument('--full', help='With --incremental, rescan all posts and reset the cursor', action='store_true')
+    parser.add_argument('--state-file', help='Incremental scan state file (default: .gpx_shortcoder_state.json)', default='.gpx_shortcoder_state.json')
+    parser.add_argument('--cache', help='SQLite file caching post listing pages; pages are revalidated with conditional GETs', default=None)
+    parser.add_argument('--cache-ttl', type=float, help='Serve cached pages younger than this many seconds without a request', default=None)
+    parser.add_argument('--cache-max-mb', type=float, help='Evict least recently used cached pages beyond this size', default=None)
+    parser.add_argument('--offline', help='Run entirely from --cache without contacting the site (implies no updates)', action='store_true')
+    parser.add_argument('--stream-json', help='Decode posts one at a time as each page downloads, so memory holds one post instead of a page', action='store_true')
+    parser.add_argument('--formats', help=f'Comma-separated track formats to look for, or "all": {", ".join(TRACK_RULES)} (default: gpx)', default='gpx')
+    parser.add_argument('--merge-tracks', help='Show all tracks of a post on one map before the first link instead of one map per link', action='store_true')
+    parser.add_argument('--detect-engine', choices=tuple(DETECTION_ENGINES), default='bs4',
+                        help='How links are found: bs4 (BeautifulSoup), lxml (needs the lxml package) or tokenizer '
+                             '(single regex pass over the HTML) (default: bs4)')
+    parser.add_argument('--compare-engines', help='Run every detection engine over the posts, report any disagreement and their timings, then exit', action='store_true')
+    parser.add_argument('--journal', help='Record the progress of live runs in this file so an interrupted run can be resumed', default=None)
+    parser.add_argument('--resume', help='Continue the run recorded in --journal, skipping finished posts and pages', action='store_true')
+    parser.add_argument('--all-fields', help='Download full post objects instead of only the fields used (for comparison)', action='store_true')
     args = parser.parse_args()
+    try:
+        run(parser, args)
+    except CacheMiss as e:
+        parser.exit(1, f"{parser.prog}: error: {e}\n")
+
+
+def run(parser, args):
+    """Carry out the run described by the parsed command line. Usage
+    errors are reported through parser.
+    """
+    formats = [name.strip().lower().lstrip('.') for name in args.formats.split(',') if name.strip()]
+    if 'all' in formats:
+        formats = list(TRACK_RULES)
+    unknown = [name for name in formats if name not in TRACK_RULES]
+    if unknown or not formats:
+        parser.error(f"--formats: unknown format(s) {', '.join(unknown)}; choose from {', '.join(TRACK_RULES)}")
+    args.formats = tuple(formats)
 
     site = args.site.rstrip('/')
     # determine API base
@@ -199,11 +1946,51 @@ def main():
     posts_processed = 0
     updates = []
 
+    if args.wxr and (args.prefilter or args.verify_prefilter):
+        parser.error('--prefilter uses the REST API search and cannot be used with --wxr')
+    if args.stream_json and (args.cache or args.engine == 'async'):
+        parser.error('--stream-json cannot be combined with --cache or --engine async')
+    pool_size = max(args.concurrency, 1) + (args.write_workers if args.write_workers > 1 else 0)
+    if args.stream_json:
+        # A streamed page keeps its connection until its posts are read, and
+        # the sliding window can hold --concurrency pages plus the one being
+        # read; updates are sent meanwhile, so every writing thread needs a
+        # connection of its own or the first write waits forever.
+        writers = args.write_workers if args.write_workers > 1 else (
+            args.transform_workers if args.engine == 'pipeline' else 1)
+        pool_size = max(args.concurrency, 1) + 1 + writers
+        if args.pool_size and args.pool_size < pool_size:
+            parser.error(f'--pool-size must be at least {pool_size} with --stream-json '
+                         '(--concurrency, plus one, plus a connection per writing thread)')
+    if args.detect_engine == 'lxml':
+        try:
+            import lxml.html  # noqa: F401
+        except ImportError:
+            parser.error('--detect-engine lxml requires the lxml package (pip install lxml)')
+    if args.compare_engines and not (args.dry_run or args.preview):
+        parser.error('--compare-engines only reads posts; use it with --dry-run')
+    if args.workers > 1 and args.engine != 'sync':
+        parser.error('--workers is for the default sync engine; --engine pipeline uses --detect-workers and --transform-workers')
+    if args.resume and not args.journal:
+        parser.error('--resume requires --journal')
+    if args.journal and args.engine == 'async':
+        parser.error('--journal cannot be used with --engine async')
+    if args.wxr and args.engine == 'async':
+        parser.error('--engine async reads posts over the REST API and cannot be used with --wxr')
+    if args.offline:
+        if not args.cache:
+            parser.error('--offline requires --cache')
+        if not args.dry_run and not args.preview:
+            parser.error('--offline cannot update posts; use --dry-run or --preview')
+
     auth = None
     # If the user provided credentials, use them (even in preview mode) so
     # preview can fetch raw/source content. Only require credentials when
     # performing live updates and the user did not supply --user.
-    if args.user:
+    if args.user and args.offline:
+        # The user only selects which cached pages to read
+        auth = (args.user, '')
+    elif args.user:
         pwd = getpass.getpass(prompt='Application password: ')
         auth = (args.user, pwd)
     else:
@@ -231,64 +2018,210 @@ def main():
         else:
             os.makedirs(preview_dir, exist_ok=True)
 
-    # When auth is provided, pass it to get_posts so we can request context=edit
-    for post in get_posts(api_base, per_page=50, auth=auth):
-        if args.limit and posts_processed >= args.limit:
-            break
-        post_id = post.get('id')
-        title = post.get('title', {}).get('rendered', '')
-        content_obj = post.get('content', {})
-        # Use source/raw content if available (requires authenticated edit context)
-        if auth and 'raw' in content_obj:
-            content = content_obj.get('raw') or content_obj.get('rendered', '')
+    retry = RetryPolicy(max_retries=args.max_retries, budget=args.retry_budget)
+    session = make_session(auth, pool_size=args.pool_size or pool_size, retry=retry)
+    query = {}
+    if not args.all_fields:
+        query['_fields'] = post_fields(auth)
+
+    cache = None
+    if args.cache:
+        max_bytes = int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None
+        cache = PageCache(args.cache, ttl=args.cache_ttl, max_bytes=max_bytes, offline=args.offline)
+
+    # Incremental mode: only ask for posts modified since the last live run
+    state = cursor = None
+    if args.incremental:
+        state = load_state(args.state_file)
+        cursor = dict(state.get(api_base, {}))
+        if cursor.get('modified_after') and not args.full:
+            print(f"Incremental scan: posts modified after {cursor['modified_after']}")
+            query['modified_after'] = cursor['modified_after']
         else:
-            # Fallback to rendered content (shortcodes will be expanded)
-            content = content_obj.get('rendered', '')
-            # print a visible warning so the user knows source content wasn't available
-            print("Warning: using rendered post content (shortcodes may already be expanded).")
-        link_matches = find_gpx_links(content, site)
-        if not link_matches:
-            continue
-        print(f"Found {len(link_matches)} gpx link(s) in post {post_id}: {title}")
-        new_content = content
-        for a_tag, file_url, file_title in link_matches:
-            relpath = compute_relative_path(file_url, post.get('link') or post.get('guid', {}).get('rendered', site))
-            sc = SHORTCODE_TPL.format(relpath=relpath, title=file_title)
-            new_content = insert_shortcode_into_html(new_content, a_tag, sc)
-
-        if new_content != content:
-            updates.append({'post_id': post_id, 'title': title, 'old': content, 'new': new_content})
-            if args.dry_run:
-                print(f"DRY RUN - would update post {post_id} ({title})")
-            elif args.preview:
-                # Write before/after preview files: preview/<post_id>-<slug>-before.html and -after.html
-                import os
-                slug = post.get('slug') or str(post_id)
-                before_filename = f"{post_id}-{slug}-before.html"
-                after_filename = f"{post_id}-{slug}-after.html"
-                before_path = os.path.join(preview_dir, before_filename)
-                after_path = os.path.join(preview_dir, after_filename)
-                try:
-                    with open(before_path, 'w', encoding='utf-8') as fh:
-                        fh.write(content)
-                    with open(after_path, 'w', encoding='utf-8') as fh:
-                        fh.write(new_content)
-                    print(f"Wrote preview for post {post_id} to {before_path} and {after_path}")
-                except Exception as e:
-                    print(f"Failed to write preview for post {post_id}: {e}")
-            else:
-                print(f"Updating post {post_id} ({title})...")
-                try:
-                    res = update_post(api_base, post_id, new_content, auth)
-                    print(f"Updated post {post_id}")
-                except Exception as e:
-                    print(f"Failed to update post {post_id}: {e}")
+            print("Incremental scan: no cursor yet (or --full), scanning all posts")
+        if '_fields' in query:
+            query['_fields'] += ',modified'
+    if args.check_conflicts and '_fields' in query:
+        query['_fields'] += ',modified_gmt'
 
-        posts_processed += 1
+    # Post types to scan, and the REST routes they are read from / written to
+    types = [t.strip() for t in args.types.split(',') if t.strip()] if args.types else ['post']
+    type_routes = {'post': DEFAULT_ROUTE}
+    if args.types and not (args.wxr and (args.dry_run or args.preview)):
+        if args.offline:
+            parser.error('--types discovers routes from the site and cannot be used with --offline')
+        try:
+            type_routes = get_type_routes(session, api_base, types)
+        except ValueError as e:
+            parser.error(str(e))
+    routes = list(dict.fromkeys(type_routes.values()))
+
+    batch_size = None
+    if args.batch and not (args.dry_run or args.preview):
+        batch_size = get_batch_size(session, api_base)
+        if batch_size:
+            print(f"Batching updates, {batch_size} per request")
+        else:
+            print("Batch endpoint not available; writing posts one at a time")
+    refresh = None
+    if args.check_conflicts:
+        refresh = functools.partial(refresh_post, session, api_base, type_routes=type_routes, site=site,
+                                    fields=query.get('_fields'), engine=args.detect_engine, formats=args.formats,
+                                    merge=args.merge_tracks)
+    journal = None
+    if args.journal and not (args.dry_run or args.preview):
+        journal = RunJournal(args.journal, resume=args.resume)
+    writer = PostWriter(session, api_base, type_routes, batch_size=batch_size, workers=args.write_workers,
+                        refresh=refresh, journal=journal)
+
+    if args.prefilter or args.verify_prefilter:
+        search_query = dict(query, search=args.prefilter_term)
+        if args.verify_prefilter:
+            candidate_keys, matched_keys, missed_keys = verify_prefilter(
+                get_posts(api_base, per_page=50, auth=auth, concurrency=args.concurrency, session=session,
+                          query=search_query, cache=cache, routes=routes),
+                get_posts(api_base, per_page=50, auth=auth, concurrency=args.concurrency, session=session,
+                          query=query, cache=cache, routes=routes),
+                site, engine=args.detect_engine, formats=args.formats)
+            print('\nPrefilter verification:')
+            print(f"Candidates returned by search={args.prefilter_term!r}: {len(candidate_keys)}")
+            print(f"Posts with track links in a full scan: {len(matched_keys)}")
+            print(f"Posts with track links missed by the prefilter: {len(missed_keys)}")
+            for post_type, post_id in sorted(missed_keys, key=str):
+                print(f"  missed {post_type} {post_id}")
+            if cache is not None:
+                cache.close()
+            return
+        print(f"Prefilter: only scanning posts matching search={args.prefilter_term!r}")
+        query = search_query
+
+    if args.wxr:
+        posts = get_wxr_posts(args.wxr, post_types=None if 'all' in types else types)
+    else:
+        # When auth is provided, pass it to get_posts so we can request context=edit
+        start_pages = {}
+        if journal is not None:
+            start_pages = {route: journal.start_page(route) for route in routes}
+            for route, page in start_pages.items():
+                if page > 1:
+                    print(f"Resuming {route} at page {page}")
+        posts = get_posts(api_base, per_page=50, auth=auth, concurrency=args.concurrency, session=session,
+                          query=query, cache=cache, routes=routes, stream=args.stream_json, journal=journal,
+                          start_pages=start_pages)
+
+    if args.compare_engines:
+        engines = list(DETECTION_ENGINES)
+        try:
+            import lxml.html  # noqa: F401
+        except ImportError:
+            engines.remove('lxml')
+            print("lxml is not installed; comparing the other engines")
+        timings, mismatches = compare_engines(itertools.islice(posts, args.limit) if args.limit else posts, site,
+                                              engines, args.formats)
+        print('\nDetection engine comparison:')
+        for engine, seconds in timings.items():
+            rate = f", {metrics['posts_compared'] / seconds:.0f} posts/s" if seconds else ''
+            print(f"{engine}: {seconds:.3f}s{rate}")
+        print(f"Posts where the engines disagree: {len(mismatches)}")
+        for post_id in mismatches:
+            print(f"  post {post_id}")
+        if cache is not None:
+            cache.close()
+        return
+
+    if args.engine == 'async':
+        read_page = functools.partial(fetch_posts_page, session, api_base, per_page=50, auth=auth, query=query,
+                                      cache=cache)
+        posts_processed, updates = asyncio.run(run_async(args, site, read_page, writer.write, preview_dir,
+                                                         routes=routes, cursor=cursor))
+    elif args.engine == 'pipeline':
+        posts_processed, updates = run_pipeline(args, site, posts, writer, preview_dir, cursor=cursor,
+                                                journal=journal)
+    else:
+        def unfinished_posts():
+            for post in posts:
+                if journal is not None and journal.resumed(post):
+                    advance_cursor(cursor, post)
+                    continue
+                yield post
+
+        transformed = transform_posts(unfinished_posts(), site, engine=args.detect_engine, formats=args.formats,
+                                      merge=args.merge_tracks, workers=args.workers)
+        for post, content, is_source, new_content, link_matches in transformed:
+            if args.limit and posts_processed >= args.limit:
+                break
+            if not is_source:
+                # print a visible warning so the user knows source content wasn't available
+                print(RENDERED_CONTENT_WARNING)
+            advance_cursor(cursor, post)
+            if not link_matches:
+                if journal is not None:
+                    journal.record(post, 'skipped')
+                continue
+            if report_post(args, preview_dir, post, content, new_content, link_matches, updates):
+                if journal is not None:
+                    journal.record(post, 'transformed')
+                writer.write(post, new_content)
+            elif journal is not None:
+                journal.record(post, 'skipped')
+            posts_processed += 1
+        transformed.close()
+    writer.close()
+    if journal is not None:
+        journal.close()
 
     print('\nSummary:')
     print(f"Posts processed: {posts_processed}")
     print(f"Posts to update: {len(updates)}")
+    if not (args.dry_run or args.preview):
+        print(f"Posts updated: {metrics['posts_written']}")
+        print(f"Failed updates: {metrics['update_failures']}")
+    if cache is not None:
+        cache.close()
+        print(f"Page cache: {metrics['cache_fresh_hits']} served without a request, "
+              f"{metrics['cache_hits']} revalidated (304), {metrics['cache_misses']} miss(es), "
+              f"{metrics['cache_bytes_saved']} bytes saved, {metrics['cache_evictions']} evicted")
+    if cursor is not None:
+        if args.dry_run or args.preview:
+            print("Incremental cursor not saved (dry run / preview)")
+        elif args.limit and posts_processed >= args.limit:
+            print("Incremental cursor not saved: scan stopped early at --limit")
+        elif metrics['update_failures']:
+            print("Incremental cursor not saved: some updates failed, they will be retried next run")
+        elif cursor.get('modified_after'):
+            state[api_base] = cursor
+            save_state(args.state_file, state)
+            print(f"Incremental cursor saved: {cursor['modified_after']}")
+    if metrics['parsed'] or metrics['rejected_substring'] or metrics['rejected_href_scan']:
+        print(f"Link detection: {metrics['rejected_substring']} post(s) rejected by the extension search, "
+              f"{metrics['rejected_href_scan']} by the href scan, {metrics['rejected_mapped']} already mapped, "
+              f"{metrics['parsed']} parsed")
+    # Cache counts of this process plus those reported by --workers processes
+    url_counts = url_cache_counts() + metrics
+    url_rates = []
+    for name in URL_CACHES:
+        hits = url_counts[f'url_cache_hits_{name}']
+        lookups = hits + url_counts[f'url_cache_misses_{name}']
+        if lookups:
+            url_rates.append(f"{name} {100 * hits / lookups:.0f}% of {lookups}")
+    if url_rates:
+        print(f"URL cache hit rates: {', '.join(url_rates)}")
+    if metrics['links_already_mapped']:
+        print(f"Links already mapped by an osm_map_v3 shortcode: {metrics['links_already_mapped']} (skipped)")
+    if journal is not None:
+        print(f"Journal: {args.journal} ({metrics['posts_resumed']} post(s) finished by an earlier run skipped)")
+    if metrics['conflicts']:
+        print(f"Conflicting edits: {metrics['conflicts']} post(s) changed while running, "
+              f"{metrics['conflicts_reapplied']} re-applied to the current version")
+    if metrics['batch_requests']:
+        print(f"Batched writes: {metrics['batch_items_written']} post(s) in {metrics['batch_requests']} request(s), "
+              f"{metrics['batch_items_retried']} item retr(ies)")
+    if metrics['retries'] or metrics['retries_refused']:
+        print(f"Retries: {metrics['retries']} (total backoff {metrics['backoff_seconds']:.1f}s), "
+              f"{metrics['retries_refused']} refused by the retry budget")
+    if metrics['posts_fetched']:
+        print(f"Posts fetched: {metrics['posts_fetched']} ({metrics['bytes_fetched']} bytes, "
+              f"{metrics['bytes_fetched'] // metrics['posts_fetched']} bytes/post)")
 
 
 if __name__ == '__main__':